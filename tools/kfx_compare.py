@@ -0,0 +1,960 @@
+#!/usr/bin/env -S uv run --script
+# /// script
+# requires-python = ">=3.10"
+# dependencies = ["rapidfuzz"]
+# ///
+"""Fragment-level comparison of two KFX builds, with source lookups.
+
+The most detailed of the KFX diff tools: it pairs up fragments of each major
+type between the builds, deep-diffs the pairs that changed, and compares the
+books paragraph by paragraph. Given a section name it can also follow that
+section through its storylines down to the content fragments, and given the
+original EPUB it shows which classes and CSS rules fed the section — handy
+for deciding whether a conversion change is our bug or the source's quirk.
+
+Usage:
+  kfx_compare.py old.kfx new.kfx
+  kfx_compare.py old.kfx new.kfx --section styles
+  kfx_compare.py old.kfx new.kfx --content-section a198
+  kfx_compare.py old.kfx new.kfx --epub book.epub --epub-section chapter-1
+"""
+
+import argparse
+import re
+import sys
+import threading
+import zipfile
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
+from functools import partial
+from io import StringIO
+from operator import itemgetter
+
+from kfx_loader import load_kfx, unwrap_annotation
+from kfx_symbols import format_symbol
+
+# String similarity: rapidfuzz's C implementation when available (the uv
+# header installs it; its score_cutoff doubles as our branch-and-bound
+# floor), difflib otherwise.
+try:
+    from rapidfuzz.fuzz import ratio as _rf_ratio
+except ImportError:
+    _rf_ratio = None
+
+# Reusable matcher for the difflib fallback, so similarity_score doesn't
+# construct one per string pair. Thread-local because the analysis passes
+# can run concurrently; autojunk off, since our strings are structured
+# values rather than prose with popular-character noise.
+_TLS = threading.local()
+
+
+def _seq_matcher():
+    sm = getattr(_TLS, "sm", None)
+    if sm is None:
+        sm = _TLS.sm = SequenceMatcher(autojunk=False)
+    return sm
+
+# ftype of each analyzed area, in report order.
+ANALYZED_TYPES = [
+    ("$145", "Content"),
+    ("$157", "Styles"),
+    ("$259", "Storylines"),
+    ("$260", "Sections"),
+    ("$266", "Anchors"),
+]
+
+# Below this many combined fragments the analysis passes run serially; the
+# pool and per-pass buffers only pay off on book-sized inputs.
+PARALLEL_THRESHOLD = 2000
+
+# Fragment types each --section run actually reads, so load_kfx can skip
+# decoding everything else; a full run still loads every type.
+SECTION_LOAD_TYPES = {
+    "content": ["$145"],
+    "styles": ["$157"],
+    "storylines": ["$259"],
+    "sections": ["$260"],
+    "anchors": ["$266"],
+}
+
+
+# format_symbol is lru_cache'd, but the wrapper is hot enough (every dict
+# key in every diff path and formatted value goes through it) that even the
+# lru_cache bookkeeping shows up; a plain dict hit is cheaper.
+_sym_cache = {}
+
+
+def sym(s):
+    r = _sym_cache.get(s)
+    if r is None:
+        r = _sym_cache[s] = format_symbol(s)
+    return r
+
+
+# Containers shared between fragments (style dicts, reused template lists)
+# would otherwise re-normalize once per referencing fragment. Keyed by
+# (id, depth): the loaded fragment trees stay alive for the run so ids are
+# stable, and depth is part of the key because the truncation horizon
+# depends on it. The entry points clear the table between runs.
+_norm_value_cache = {}
+
+
+def _norm_dict(val, depth):
+    key = (id(val), depth)
+    cached = _norm_value_cache.get(key)
+    if cached is None:
+        cached = _norm_value_cache[key] = {
+            str(k): normalize_value(v, depth + 1)
+            for k, v in sorted(val.items(), key=lambda kv: str(kv[0]))}
+    return cached
+
+
+def _norm_list(val, depth):
+    key = (id(val), depth)
+    cached = _norm_value_cache.get(key)
+    if cached is None:
+        cached = _norm_value_cache[key] = [
+            normalize_value(v, depth + 1) for v in val]
+    return cached
+
+
+def _norm_bytes(val, depth):
+    return "<%d bytes>" % len(val)
+
+
+def _norm_str(val, depth):
+    return str(val)
+
+
+# Exact-type dispatch replaces the isinstance cascade on the hot path;
+# subclasses (Ion symbol strings, annotation-wrapped dicts) miss the table
+# and fall back to the isinstance scan below.
+_NORM_DISPATCH = {
+    dict: _norm_dict,
+    list: _norm_list,
+    tuple: _norm_list,
+    str: _norm_str,
+    bytes: _norm_bytes,
+    bytearray: _norm_bytes,
+}
+
+
+def normalize_value(val, depth=0):
+    """Reduce an Ion value to plain sorted Python data for comparison."""
+    val = unwrap_annotation(val)
+    if depth > 10:
+        return "..."
+    handler = _NORM_DISPATCH.get(type(val))
+    if handler is None:
+        for cls, h in _NORM_DISPATCH.items():
+            if isinstance(val, cls):
+                handler = h
+                break
+        else:
+            return val
+    return handler(val, depth)
+
+
+# Fragments are normalized again in every pass that touches them (matching,
+# style grouping, section tracing); normalize each one once instead. Keyed by
+# id() since Fragment uses __slots__ without __weakref__, and entries live for
+# the run, which is bounded by the two books' fragment counts.
+_NORM_CACHE = {}
+
+
+def _norm(frag):
+    key = id(frag)
+    cached = _NORM_CACHE.get(key)
+    if cached is None:
+        cached = _NORM_CACHE[key] = normalize_value(frag.value)
+    return cached
+
+
+def get_fragment_signature(frag, norm=None):
+    """A string equal fragments share: type plus normalized shape."""
+    if norm is None:
+        norm = _norm(frag)
+    return "%s:%r" % (frag.ftype, norm)
+
+
+# Placeholder for "key absent on this side" in deep_diff frames; distinct
+# from None, which is a legal stored value.
+_ABSENT = object()
+
+
+def _diff_dict(v1, v2, path, stack, diffs):
+    for k in sorted(set(v1) | set(v2), reverse=True):
+        sub = "%s.%s" % (path, sym(k)) if path else sym(k)
+        stack.append((v1.get(k, _ABSENT), v2.get(k, _ABSENT), sub))
+
+
+def _diff_list(v1, v2, path, stack, diffs):
+    if len(v1) != len(v2):
+        diffs.append((path, "length", len(v1), len(v2)))
+    for i in range(min(len(v1), len(v2)) - 1, -1, -1):
+        stack.append((v1[i], v2[i], "%s[%d]" % (path, i)))
+
+
+# deep_diff operates on normalized values, so these exact types cover
+# everything in practice; the isinstance check in the loop is the escape
+# hatch for anything that slips through unnormalized.
+_DIFF_DISPATCH = {dict: _diff_dict, list: _diff_list}
+
+
+# Whole-call deep_diff results by (id, id); fragments diffed in more than
+# one pass (the per-type report, then a section trace) pay the walk once.
+_diff_cache = {}
+
+
+def deep_diff(val1, val2, path=""):
+    """All (path, kind, v1, v2) differences between two normalized values.
+
+    Walks with an explicit stack instead of recursion — one Python frame
+    total rather than one per node, and no recursion limit on pathologically
+    deep values. Children are pushed in reverse so popping emits diffs in
+    the same sorted-key/index order the recursive version produced.
+    """
+    if val1 is val2:
+        return []
+    # Only whole-value calls are cached; a caller-supplied path prefix
+    # would bake itself into the stored tuples.
+    key = (id(val1), id(val2)) if path == "" else None
+    if key is not None:
+        cached = _diff_cache.get(key)
+        if cached is not None:
+            return cached
+    diffs = []
+    stack = [(val1, val2, path)]
+    while stack:
+        v1, v2, path = stack.pop()
+        if v1 is _ABSENT:
+            diffs.append((path, "added", None, v2))
+            continue
+        if v2 is _ABSENT:
+            diffs.append((path, "removed", v1, None))
+            continue
+        if type(v1) is not type(v2):
+            diffs.append((path, "type", v1, v2))
+            continue
+        handler = _DIFF_DISPATCH.get(type(v1))
+        if handler is None and isinstance(v1, (dict, list)):
+            handler = _diff_dict if isinstance(v1, dict) else _diff_list
+        if handler is not None:
+            handler(v1, v2, path, stack, diffs)
+        elif v1 != v2:
+            diffs.append((path, "changed", v1, v2))
+    if key is not None:
+        _diff_cache[key] = diffs
+    return diffs
+
+
+def _sim_dict(val1, val2, min_needed):
+    keys1, keys2 = set(val1), set(val2)
+    if not keys1 and not keys2:
+        return 1.0
+    key_score = len(keys1 & keys2) / len(keys1 | keys2)
+    # Even with every shared value identical the score caps at
+    # (key_score + 1) / 2; bail before visiting any values.
+    if (key_score + 1.0) / 2 < min_needed:
+        return 0.0
+    shared = keys1 & keys2
+    if not shared:
+        return key_score / 2
+    # The value average must reach 2 * min_needed - key_score; track the
+    # running sum and give each child the floor implied by scoring the
+    # rest perfectly.
+    needed = (2.0 * min_needed - key_score) * len(shared)
+    total = 0.0
+    remaining = len(shared)
+    for k in shared:
+        remaining -= 1
+        total += similarity_score(val1[k], val2[k],
+                                  needed - total - remaining)
+        if total + remaining < needed:
+            return 0.0
+    return (key_score + total / len(shared)) / 2
+
+
+def _sim_list(val1, val2, min_needed):
+    if not val1 and not val2:
+        return 1.0
+    if not val1 or not val2:
+        return 0.0
+    n = min(len(val1), len(val2))
+    longer = max(len(val1), len(val2))
+    # item_score * (n / longer) >= min_needed means the item sum must
+    # reach min_needed * longer.
+    needed = min_needed * longer
+    total = 0.0
+    remaining = n
+    for a, b in zip(val1, val2):
+        remaining -= 1
+        total += similarity_score(a, b, needed - total - remaining)
+        if total + remaining < needed:
+            return 0.0
+    return (total / n) * (n / longer)
+
+
+def _sim_str(val1, val2, min_needed):
+    if val1 == val2:
+        return 1.0
+    if _rf_ratio is not None:
+        return _rf_ratio(val1, val2, score_cutoff=min_needed * 100.0) / 100.0
+    sm = _seq_matcher()
+    sm.set_seq2(val2)
+    sm.set_seq1(val1)
+    if sm.real_quick_ratio() <= min_needed:
+        return 0.0
+    if sm.quick_ratio() <= min_needed:
+        return 0.0
+    return sm.ratio()
+
+
+_SIM_DISPATCH = {dict: _sim_dict, list: _sim_list, tuple: _sim_list,
+                 str: _sim_str}
+
+
+# Scores by (id, id) pair: the residual searches rescore the same shared
+# sub-values against each other across candidates. Pruned answers are not
+# stored — see below — and the entry points clear the table between runs.
+_sim_cache = {}
+
+
+def similarity_score(val1, val2, min_needed=0.0):
+    """Structural similarity of two normalized values in [0, 1].
+
+    min_needed is a branch-and-bound cutoff: when even a perfect remainder
+    cannot reach it, the answer is reported as 0.0 without descending
+    further. Callers that only compare against a current best score pass
+    that score here and lose nothing.
+    """
+    if val1 is val2:
+        return 1.0
+    key = (id(val1), id(val2))
+    score = _sim_cache.get(key)
+    if score is not None:
+        return score
+    if type(val1) is not type(val2):
+        score = 0.0
+    else:
+        handler = _SIM_DISPATCH.get(type(val1))
+        if handler is None:
+            for cls, h in _SIM_DISPATCH.items():
+                if isinstance(val1, cls):
+                    handler = h
+                    break
+        if handler is not None:
+            score = handler(val1, val2, min_needed)
+        else:
+            score = 1.0 if val1 == val2 else 0.0
+    # A 0.0 under a nonzero floor may be a pruned answer rather than the
+    # true score; caching it would poison later calls with lower floors.
+    if score > 0.0 or min_needed <= 0.0:
+        _sim_cache[key] = score
+    return score
+
+
+def match_fragments(list1, list2):
+    """Pair up fragments across the builds; returns (matched, only1, only2).
+
+    Exact-signature pairs are taken from a hash bucket in O(1) each; only the
+    residual fragments fall back to the quadratic similarity search.
+    """
+    pairs1 = [(f, _norm(f)) for f in list1]
+    pairs2 = [(f, _norm(f)) for f in list2]
+
+    by_sig = defaultdict(deque)
+    for j, (f2, v2) in enumerate(pairs2):
+        by_sig[get_fragment_signature(f2, v2)].append(j)
+
+    matched = []
+    used2 = set()
+    residual1 = []
+    for f1, v1 in pairs1:
+        bucket = by_sig.get(get_fragment_signature(f1, v1))
+        if bucket:
+            j = bucket.popleft()
+            used2.add(j)
+            matched.append((f1, pairs2[j][0], 1.0))
+        else:
+            residual1.append((f1, v1))
+
+    # The residual search only considers candidates of comparable size: a
+    # fragment serialized 30% longer or shorter can't plausibly be the same
+    # one edited, and bisecting the sorted lengths trims each scan to the
+    # band instead of the whole residue.
+    residual2 = sorted((len(str(v2)), j)
+                       for j, (f2, v2) in enumerate(pairs2)
+                       if j not in used2)
+    lengths = [length for length, j in residual2]
+
+    for f1, v1 in residual1:
+        best_score = 0.5
+        best_j = None
+        size = len(str(v1))
+        lo = bisect_left(lengths, 0.7 * size)
+        hi = bisect_right(lengths, 1.3 * size)
+        for k in range(lo, hi):
+            j = residual2[k][1]
+            if j in used2:
+                continue
+            score = similarity_score(v1, pairs2[j][1], best_score)
+            if score > best_score:
+                best_score = score
+                best_j = j
+        if best_j is not None:
+            used2.add(best_j)
+            matched.append((f1, pairs2[best_j][0], best_score))
+
+    matched1 = {id(m[0]) for m in matched}
+    only1 = [f for f, v in pairs1 if id(f) not in matched1]
+    only2 = [f for j, (f, v) in enumerate(pairs2) if j not in used2]
+    return matched, only1, only2
+
+
+# Pads for format_value, precomputed so each line doesn't allocate a fresh
+# "  " * indent string; diff values never nest anywhere near 32 deep.
+_INDENT_CACHE = ["  " * i for i in range(33)]
+
+
+def _pad(indent):
+    if indent < len(_INDENT_CACHE):
+        return _INDENT_CACHE[indent]
+    return "  " * indent
+
+
+def format_value(val, indent=0):
+    """Multi-line rendering of a normalized value for diff output.
+
+    Writes lines into one list joined at the end — no per-level joins and
+    no recursion. Each work item carries the prefix its first line gets
+    (pad, or pad plus "key: " for dict values); closing braces are pushed
+    as ready-made lines.
+    """
+    out = []
+    append = out.append
+    stack = [(val, indent, _pad(indent))]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            append(item)
+            continue
+        val, indent, prefix = item
+        if isinstance(val, dict):
+            if not val:
+                append(prefix + "{}")
+                continue
+            append(prefix + "{")
+            stack.append(_pad(indent) + "}")
+            child_pad = _pad(indent + 1)
+            for k, v in reversed(val.items()):
+                stack.append((v, indent + 1, "%s%s: " % (child_pad, sym(k))))
+        elif isinstance(val, list):
+            if not val:
+                append(prefix + "[]")
+                continue
+            append(prefix + "[")
+            stack.append(_pad(indent) + "]")
+            child_pad = _pad(indent + 1)
+            for v in reversed(val):
+                stack.append((v, indent + 1, child_pad))
+        elif isinstance(val, str):
+            text = sym(val) if val.startswith("$") else repr(val)
+            if len(text) > 100:
+                text = text[:100] + "..."
+            append(prefix + text)
+        else:
+            append(prefix + str(val))
+    return "\n".join(out)
+
+
+def full_fragment_diff(f1, f2, limit=20, out=None):
+    """Print the deep diff between two matched fragments."""
+    p = partial(print, file=out if out is not None else sys.stdout)
+    diffs = deep_diff(_norm(f1), _norm(f2))
+    if not diffs:
+        return
+    p("  %s %s <-> %s: %d difference(s)"
+      % (sym(f1.ftype), f1.fid, f2.fid, len(diffs)))
+    for path, kind, v1, v2 in diffs[:limit]:
+        if kind == "added":
+            p("    + %s = %s" % (path, format_value(v2).strip()))
+        elif kind == "removed":
+            p("    - %s = %s" % (path, format_value(v1).strip()))
+        elif kind == "length":
+            p("    ~ %s: %d vs %d items" % (path, v1, v2))
+        else:
+            p("    ~ %s: %s -> %s"
+              % (path, format_value(v1).strip(), format_value(v2).strip()))
+    if len(diffs) > limit:
+        p("    ... %d more" % (len(diffs) - limit))
+
+
+def analyze_fragment_type(frags1, frags2, ftype, label, out=None):
+    """Match and diff all fragments of one type across the builds."""
+    p = partial(print, file=out if out is not None else sys.stdout)
+    list1 = frags1.get_all(ftype)
+    list2 = frags2.get_all(ftype)
+    p()
+    p("=== %s (%s) ===" % (label, sym(ftype)))
+    p("  %d vs %d fragments" % (len(list1), len(list2)))
+    if not list1 and not list2:
+        return
+    matched, only1, only2 = match_fragments(list1, list2)
+    exact = sum(1 for m in matched if m[2] >= 1.0)
+    p("  %d matched (%d exact), %d only in file1, %d only in file2"
+      % (len(matched), exact, len(only1), len(only2)))
+    for f1, f2, score in matched:
+        if score < 1.0:
+            full_fragment_diff(f1, f2, out=out)
+    for f in only1[:5]:
+        p("  - only in file1: %s" % f.fid)
+    for f in only2[:5]:
+        p("  + only in file2: %s" % f.fid)
+
+
+def get_style_properties(frag):
+    """The describing properties of a style, minus its identity keys."""
+    val = _norm(frag)
+    if not isinstance(val, dict):
+        return {}
+    return {k: v for k, v in val.items()
+            if k not in ("$173", "$176", "version")}
+
+
+def analyze_styles(frags1, frags2, out=None):
+    """Match styles by their properties rather than their generated names."""
+    p = partial(print, file=out if out is not None else sys.stdout)
+    styles1 = frags1.get_all("$157")
+    styles2 = frags2.get_all("$157")
+    p()
+    p("=== Styles by properties ===")
+    p("  %d vs %d styles" % (len(styles1), len(styles2)))
+
+    pairs1 = [(f, get_style_properties(f)) for f in styles1]
+    pairs2 = [(f, get_style_properties(f)) for f in styles2]
+    matched = []
+    used2 = set()
+    for f1, p1 in pairs1:
+        for j, (f2, p2) in enumerate(pairs2):
+            if j in used2:
+                continue
+            if p1 == p2:
+                matched.append((f1, f2))
+                used2.add(j)
+                break
+    matched1 = {id(m[0]) for m in matched}
+    only1 = [f for f, p in pairs1 if id(f) not in matched1]
+    only2 = [f for j, (f, p) in enumerate(pairs2) if j not in used2]
+    p("  %d matched by properties" % len(matched))
+    for f in only1[:5]:
+        p("  - only in file1: %s %s"
+          % (f.fid, format_value(get_style_properties(f)).strip()[:120]))
+    for f in only2[:5]:
+        p("  + only in file2: %s %s"
+          % (f.fid, format_value(get_style_properties(f)).strip()[:120]))
+
+
+def normalize_text(text):
+    """Whitespace-insensitive, case-insensitive comparison form."""
+    return " ".join(text.split()).lower()
+
+
+def get_paragraphs(frags):
+    """Every prose paragraph in the book, in document order."""
+    paras = []
+    append = paras.append
+    ua = unwrap_annotation
+    for frag in frags.get_all("$145"):
+        # Iterative walk with bound locals; children go on reversed so the
+        # LIFO pop keeps document order.
+        stack = [frag.value]
+        while stack:
+            val = ua(stack.pop())
+            if isinstance(val, str):
+                if len(val) > 5 and not val.startswith("$"):
+                    append(val)
+            elif isinstance(val, dict):
+                stack.extend(reversed(list(val.values())))
+            elif isinstance(val, (list, tuple)):
+                stack.extend(reversed(val))
+    return paras
+
+
+def analyze_text_content(frags1, frags2, out=None):
+    """Compare the books paragraph by paragraph."""
+    p = partial(print, file=out if out is not None else sys.stdout)
+    p()
+    p("=== Text content ===")
+    paras1 = get_paragraphs(frags1)
+    paras2 = get_paragraphs(frags2)
+    p("  %d vs %d paragraphs" % (len(paras1), len(paras2)))
+
+    # Count occurrences rather than building a normalized->original dict: a
+    # paragraph repeated on one side but not the other is a real difference
+    # the dict form silently collapsed. The multiset intersection pairs up
+    # duplicates too, and the differences leave only the true residue.
+    c1 = Counter()
+    orig1 = {}
+    for para in paras1:
+        n = normalize_text(para)
+        c1[n] += 1
+        orig1.setdefault(n, para)
+    c2 = Counter()
+    orig2 = {}
+    for para in paras2:
+        n = normalize_text(para)
+        c2[n] += 1
+        orig2.setdefault(n, para)
+    exact = c1 & c2
+    res1 = c1 - c2
+    res2 = c2 - c1
+    p("  %d exact matches, %d only in file1, %d only in file2"
+      % (sum(exact.values()), sum(res1.values()), sum(res2.values())))
+    if not res1 and not res2:
+        return
+    only1_set = set(res1)
+    only2_set = set(res2)
+
+    # Fuzzy-pair the residual paragraphs so small rewordings don't show up
+    # as one removal plus one addition. A trigram inverted index narrows each
+    # left paragraph to candidates that share trigrams, and trigram Jaccard
+    # screens those before the expensive Ratcliff-Obershelp ratio.
+    def qgrams(text):
+        if len(text) < 3:
+            return {text}
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    grams2 = {n2: qgrams(n2) for n2 in only2_set}
+    trigram_index = defaultdict(set)
+    for n2, grams in grams2.items():
+        for g in grams:
+            trigram_index[g].add(n2)
+
+    remaining2 = set(only2_set)
+    matched1 = set()
+    fuzzy_occ = 0
+    shown = 0
+    for n1 in sorted(only1_set):
+        g1 = qgrams(n1)
+        candidates = set()
+        for g in g1:
+            candidates |= trigram_index.get(g, frozenset())
+        candidates &= remaining2
+        best_score = 0.8
+        best = None
+        # Without rapidfuzz: one matcher per left paragraph, with seq2 the
+        # repeated side so difflib's cached preprocessing of it is reused
+        # across candidates, and the guaranteed upper bounds
+        # real_quick_ratio/quick_ratio rule most candidates out before the
+        # full ratio computation.
+        sm = SequenceMatcher(None, "", n1) if _rf_ratio is None else None
+        for n2 in candidates:
+            if abs(len(n1) - len(n2)) > 0.3 * len(n1):
+                continue
+            g2 = grams2[n2]
+            inter = len(g1 & g2)
+            if inter / (len(g1) + len(g2) - inter) < 0.7:
+                continue
+            if _rf_ratio is not None:
+                score = _rf_ratio(n2, n1,
+                                  score_cutoff=best_score * 100.0) / 100.0
+            else:
+                sm.set_seq1(n2)
+                if sm.real_quick_ratio() <= best_score:
+                    continue
+                if sm.quick_ratio() <= best_score:
+                    continue
+                score = sm.ratio()
+            if score > best_score:
+                best_score = score
+                best = n2
+        if best is not None:
+            remaining2.discard(best)
+            matched1.add(n1)
+            # The summary counts occurrences, same units as the exact-match
+            # line: a matched normalized paragraph carries its duplicate
+            # count through the fuzzy stage.
+            fuzzy_occ += res1[n1]
+            shown += 1
+            if shown <= 5:
+                p("  ~ %.0f%%: %r" % (best_score * 100, n1[:60]))
+                p("         -> %r" % best[:60])
+    p("  %d fuzzy matches, %d + %d truly unmatched"
+      % (fuzzy_occ, sum(res1.values()) - fuzzy_occ,
+         sum(res2[n] for n in remaining2)))
+    for n1 in sorted(only1_set - matched1)[:3]:
+        p("  - %r" % orig1[n1][:80])
+    for n2 in sorted(remaining2)[:3]:
+        p("  + %r" % orig2[n2][:80])
+
+
+def find_section_text(frags, section_name):
+    """Content fragment ids reachable from a named section, in order."""
+    story_names = []
+    for frag in frags.get_all("$260"):
+        val = _norm(frag)
+        if str(val.get("$174")) != section_name:
+            continue
+        for template in val.get("$141", []):
+            if isinstance(template, dict) and "$176" in template:
+                story_names.append(str(template["$176"]))
+    content_ids = []
+    seen = set()
+    ua = unwrap_annotation
+    storylines = frags.get_all("$259")
+    for story_name in story_names:
+        for frag in storylines:
+            if str(_norm(frag).get("$176")) != story_name:
+                continue
+            # Content refs nest inside container items (a $146 list within
+            # a $146 item), so walk the whole storyline — the same stack
+            # walk index_content_items uses — rather than only the
+            # top-level items; reversed pushes keep first-seen document
+            # order.
+            stack = [frag.value]
+            while stack:
+                val = ua(stack.pop())
+                if isinstance(val, dict):
+                    ref = val.get("$145")
+                    if ref is not None:
+                        ref = ua(ref)
+                        if isinstance(ref, dict) and "name" in ref:
+                            cid = str(ref["name"])
+                            if cid not in seen:
+                                seen.add(cid)
+                                content_ids.append(cid)
+                    stack.extend(reversed(list(val.values())))
+                elif isinstance(val, (list, tuple)):
+                    stack.extend(reversed(val))
+    return content_ids
+
+
+def get_all_texts(content_idx, content_id):
+    """The text strings of one $145 content fragment, via the id index."""
+    frag = content_idx.get(str(content_id))
+    if frag is None:
+        return []
+    val = _norm(frag)
+    return [t for t in val.get("$146", []) if isinstance(t, str)]
+
+
+def index_content_items(storylines):
+    """Every storyline item that references content, grouped by content id.
+
+    One walk over the storylines replaces a full rescan per content id in
+    analyze_content_section.
+    """
+    index = defaultdict(list)
+    ua = unwrap_annotation
+    for frag in storylines:
+        story_name = str(ua(frag.value).get("$176", frag.fid))
+        stack = [frag.value]
+        while stack:
+            val = ua(stack.pop())
+            if isinstance(val, dict):
+                ref = val.get("$145")
+                if ref is not None:
+                    ref = ua(ref)
+                    if isinstance(ref, dict) and "name" in ref:
+                        index[str(ref["name"])].append({
+                            "story": story_name,
+                            "offset": ref.get("$403", 0),
+                            "id": val.get("$155"),
+                            "style": str(val.get("$157", "")),
+                        })
+                stack.extend(val.values())
+            elif isinstance(val, (list, tuple)):
+                stack.extend(val)
+    return index
+
+
+def find_content_items(content_items, content_id):
+    """Storyline items that reference a content fragment, with positions."""
+    return sorted(content_items.get(str(content_id), ()),
+                  key=itemgetter("offset"))
+
+
+def analyze_content_section(frags1, frags2, section_name):
+    """Follow one section through storylines to its text, in both builds."""
+    _NORM_CACHE.clear()
+    _norm_value_cache.clear()
+    _sim_cache.clear()
+    _diff_cache.clear()
+    print()
+    print("=== Section %s ===" % section_name)
+    for label, frags in (("file1", frags1), ("file2", frags2)):
+        # One pass each over the content and storyline fragments; every
+        # per-id lookup below goes through these instead of re-scanning.
+        content_idx = {str(f.fid): f for f in frags.get_all("$145")}
+        content_items = index_content_items(frags.get_all("$259"))
+        content_ids = find_section_text(frags, section_name)
+        print("  %s: content fragments %s" % (label, content_ids or "none"))
+        for cid in content_ids:
+            texts = get_all_texts(content_idx, cid)
+            total = sum(len(t) for t in texts)
+            print("    %s: %d blocks, %d chars" % (cid, len(texts), total))
+            for item in find_content_items(content_items, cid)[:5]:
+                print("      item %s offset %s style %s (story %s)"
+                      % (item["id"], item["offset"], item["style"], item["story"]))
+            for text in texts[:2]:
+                print("      %r" % text[:70])
+
+
+# Compiled once: show_epub_section runs these over every CSS file and
+# chapter-sized XHTML blob in the archive.
+_RE_CLASS = re.compile(r'class="([^"]+)"')
+_RE_ID = re.compile(r'id="([^"]+)"')
+_RE_ELEM = re.compile(r"<(\w+)[\s>]")
+_RE_CSS_RULE = re.compile(r"([^{}]+)\{([^{}]+)\}")
+_RE_SELECTOR_TOKEN = re.compile(r"[.#]?[\w-]+")
+
+
+def show_epub_section(epub_path, section_hint):
+    """Show the source XHTML classes and matching CSS rules for a section."""
+    print()
+    print("=== EPUB source for %r ===" % section_hint)
+    with zipfile.ZipFile(epub_path) as z:
+        # One pass over the directory: resolve the chapter, remember the CSS
+        # names, and read nothing until it's needed.
+        names = z.namelist()
+        xhtml_file = None
+        for name in names:
+            if name.endswith((".xhtml", ".html")) and section_hint in name:
+                xhtml_file = name
+                break
+        if xhtml_file is None:
+            print("  no XHTML file matching %r" % section_hint)
+            return
+        css_names = sorted(name for name in names if name.endswith(".css"))
+        xhtml_content = z.read(xhtml_file).decode("utf-8")
+
+        print("  source: %s (%d bytes)" % (xhtml_file, len(xhtml_content)))
+        all_classes = set()
+        for group in _RE_CLASS.findall(xhtml_content):
+            all_classes.update(group.split())
+        ids_used = set(_RE_ID.findall(xhtml_content))
+        elements_used = set(_RE_ELEM.findall(xhtml_content))
+        print("  %d classes, %d ids, %d element types"
+              % (len(all_classes), len(ids_used), len(elements_used)))
+
+        for css_name in css_names:
+            raw = z.read(css_name)
+            # Rule-less files (licence stubs, @import shims) skip the decode
+            # and regex pass entirely.
+            if b"{" not in raw:
+                print("  %s: 0 of its rules apply" % css_name)
+                continue
+            css = raw.decode("utf-8")
+            relevant = []
+            for selector, body in _RE_CSS_RULE.findall(css):
+                selector = selector.strip()
+                # Tokenize the selector once; each token is a set membership
+                # instead of a per-class/per-element regex scan of the
+                # selector.
+                hit = False
+                for token in _RE_SELECTOR_TOKEN.findall(selector):
+                    if token[0] == ".":
+                        hit = token[1:] in all_classes
+                    elif token[0] == "#":
+                        hit = token[1:] in ids_used
+                    else:
+                        hit = token in elements_used
+                    if hit:
+                        break
+                if hit:
+                    relevant.append((selector, body.strip()))
+            print("  %s: %d of its rules apply" % (css_name, len(relevant)))
+            for selector, body in relevant[:5]:
+                print("    %s { %s }" % (selector, body[:80]))
+
+
+def smart_diff(file1, file2, section=None):
+    """Compare two KFX builds area by area."""
+    _NORM_CACHE.clear()
+    _norm_value_cache.clear()
+    _sim_cache.clear()
+    _diff_cache.clear()
+    types = SECTION_LOAD_TYPES.get(section) if section is not None else None
+    print("Loading %s..." % file1)
+    frags1, method1 = load_kfx(file1, types=types)
+    print("Loading %s..." % file2)
+    frags2, method2 = load_kfx(file2, types=types)
+    print("  %d vs %d fragments (%s / %s)"
+          % (len(frags1.all_fragments), len(frags2.all_fragments),
+             method1, method2))
+
+    all_types = sorted(set(frags1.types()) | set(frags2.types()))
+    summary = ["", "=== Fragment types ==="]
+    summary.extend("  %-28s %5d vs %5d"
+                   % (sym(ftype), frags1.count(ftype), frags2.count(ftype))
+                   for ftype in all_types)
+    sys.stdout.write("\n".join(summary) + "\n")
+
+    jobs = []
+    for ftype, label in ANALYZED_TYPES:
+        if section is not None and label.lower() != section:
+            continue
+        jobs.append(partial(analyze_fragment_type, frags1, frags2,
+                            ftype, label))
+    if section in (None, "styles"):
+        jobs.append(partial(analyze_styles, frags1, frags2))
+    if section in (None, "content"):
+        jobs.append(partial(analyze_text_content, frags1, frags2))
+
+    total = len(frags1.all_fragments) + len(frags2.all_fragments)
+    if len(jobs) > 1 and total >= PARALLEL_THRESHOLD:
+        # Each pass writes into its own buffer; the buffers are flushed in
+        # report order, so the output is byte-identical to a serial run.
+        buffers = [StringIO() for _ in jobs]
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = [pool.submit(job, out=buf)
+                       for job, buf in zip(jobs, buffers)]
+            for future in futures:
+                future.result()
+        sys.stdout.write("".join(buf.getvalue() for buf in buffers))
+    else:
+        # Serial runs buffer too: one write at the end instead of a
+        # syscall-sized flush per report line.
+        buf = StringIO()
+        for job in jobs:
+            job(out=buf)
+        sys.stdout.write(buf.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fragment-level comparison of two KFX builds")
+    parser.add_argument("file1", help="baseline KFX file")
+    parser.add_argument("file2", help="candidate KFX file")
+    parser.add_argument("--section", "-s",
+                        choices=[label.lower() for _, label in ANALYZED_TYPES],
+                        help="only analyze one fragment area")
+    parser.add_argument("--content-section", metavar="NAME",
+                        help="follow one named section down to its text")
+    parser.add_argument("--epub", metavar="FILE",
+                        help="original EPUB for source lookups")
+    parser.add_argument("--epub-section", metavar="HINT",
+                        help="show EPUB source whose filename contains HINT")
+    args = parser.parse_args()
+
+    if args.epub and args.epub_section:
+        show_epub_section(args.epub, args.epub_section)
+        if args.content_section is None and args.section is None:
+            return
+
+    if args.content_section is not None:
+        # Section tracing only touches sections, storylines and content.
+        types = ["$145", "$259", "$260"]
+        frags1, _ = load_kfx(args.file1, types=types)
+        frags2, _ = load_kfx(args.file2, types=types)
+        analyze_content_section(frags1, frags2, args.content_section)
+        return
+
+    smart_diff(args.file1, args.file2, section=args.section)
+
+
+if __name__ == "__main__":
+    main()
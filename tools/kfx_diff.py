@@ -0,0 +1,517 @@
+#!/usr/bin/env -S uv run --script
+# /// script
+# requires-python = ">=3.10"
+# dependencies = ["rapidfuzz", "numpy"]
+# ///
+"""Semantic diff of two KFX builds of the same book.
+
+Fragment ids are regenerated on every conversion, so a naive id-keyed diff
+reports everything as changed. This pairs fragments by content — exact
+signature match first, fuzzy similarity for the rest — and then reports
+what actually differs per area: styles, sections, storylines, anchors and
+the text itself.
+"""
+import argparse
+import functools
+import hashlib
+import itertools
+import sys
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+from kfx_loader import load_kfx, unwrap_annotation
+from kfx_symbols import format_symbol
+
+
+@functools.lru_cache(maxsize=None)
+def sym(s):
+    return format_symbol(s)
+
+
+def _key_str(k):
+    """Display form of a dict key without allocating a throwaway str(k)."""
+    if isinstance(k, str):
+        return sym(k) if k[:1] == "$" else k
+    return str(k)
+
+
+def _shingles(s, k=8):
+    return {hash(s[i:i + k]) for i in range(len(s) - k + 1)}
+
+
+def similarity(s1, s2):
+    """Similarity in [0, 1]; bit-parallel edit ratio for normal sizes, a
+    Jaccard estimate over 8-gram shingles for multi-MB text where even the
+    C edit distance gets quadratic."""
+    if not s1 and not s2:
+        return 1.0
+    if not s1 or not s2:
+        return 0.0
+    if s1 == s2:
+        return 1.0
+    if max(len(s1), len(s2)) < 100_000:
+        return fuzz.ratio(s1, s2) / 100.0
+    sh1 = _shingles(s1)
+    sh2 = _shingles(s2)
+    return len(sh1 & sh2) / len(sh1 | sh2)
+
+
+# Extraction results keyed by id(frag): the same fragment feeds signature
+# matching, the text analysis and the summary within one run, and the
+# fragment objects stay alive in their FragmentList for the process life.
+_text_cache = {}
+_structure_cache = {}
+
+
+def get_text_content(frag):
+    """All text strings reachable in a fragment, joined in walk order."""
+    key = id(frag)
+    cached = _text_cache.get(key)
+    if cached is not None:
+        return cached
+    stack = [frag.value]
+    texts = []
+    append = texts.append
+    extend = stack.extend
+    while stack:
+        v = stack.pop()
+        t = type(v)
+        if t is str:
+            append(v)
+        elif t is dict:
+            # Reversed so LIFO popping preserves document order.
+            extend(reversed(list(v.values())))
+        elif t is list or t is tuple:
+            extend(reversed(v))
+        elif isinstance(v, str):  # IonSymbol
+            append(v)
+        elif hasattr(v, "value"):  # annotation wrapper
+            stack.append(v.value)
+        elif hasattr(v, "keys"):
+            extend(reversed(list(v.values())))
+    text = " ".join(texts)
+    _text_cache[key] = text
+    return text
+
+
+_intern = sys.intern
+
+
+def _ctype(item):
+    """Interned content-type symbol of a storyline item."""
+    item = unwrap_annotation(item)
+    v = item.get("$159") if hasattr(item, "get") else None
+    if v is None:
+        return "?"
+    return _intern(v) if type(v) is str else _intern(str(v))
+
+
+def get_storyline_structure(frag):
+    """Content-type sequence of a storyline, e.g. "$269|$269|$271"."""
+    key = id(frag)
+    cached = _structure_cache.get(key)
+    if cached is not None:
+        return cached
+    parts = []
+    for item in frag.value.get("$146", []):
+        if hasattr(unwrap_annotation(item), "get"):
+            parts.append(_ctype(item))
+    structure = "|".join(parts)
+    _structure_cache[key] = structure
+    return structure
+
+
+_hash_cache = {}
+
+
+def _canon(v):
+    """Hashable canonical form of a fragment value (dicts key-sorted)."""
+    v = unwrap_annotation(v)
+    if hasattr(v, "items"):
+        return tuple(sorted((str(k), _canon(x)) for k, x in v.items()))
+    if isinstance(v, (list, tuple)):
+        return tuple(_canon(x) for x in v)
+    return v
+
+
+def value_hash(frag):
+    """Content hash of a fragment's value, cached per fragment — lets the
+    common identical-fragment case skip both the == tree walk and the diff
+    walk."""
+    key = id(frag)
+    h = _hash_cache.get(key)
+    if h is None:
+        h = _hash_cache[key] = hash(_canon(frag.value))
+    return h
+
+
+def get_style_name(frag):
+    return str(frag.value.get("$173", frag.fid))
+
+
+def get_section_name(frag):
+    return str(frag.value.get("$174", frag.fid))
+
+
+def content_signature(frag):
+    """A comparable string capturing a fragment's content, ignoring ids."""
+    if frag.ftype == "$259":
+        return get_storyline_structure(frag)
+    if frag.ftype == "$145":
+        return get_text_content(frag)[:500]
+    return format_value_compact(frag.value, max_depth=3, max_len=500)
+
+
+# Minimum fuzz.ratio (0-100) for a fuzzy pairing to count as a match.
+_SCORE_CUTOFF = 50
+
+
+def match_fragments_by_content(frags1, frags2, ftype):
+    """Pair fragments of one type across the two books by signature.
+
+    Identical signatures (the common case — most fragments survive a
+    reconversion untouched) pair up through exact-match buckets in one pass.
+    Only the leftovers go through fuzzy scoring, and that happens as a single
+    vectorized rapidfuzz score matrix rather than a Python SequenceMatcher
+    call per pair.
+
+    Returns (matched, unmatched1, unmatched2) where matched holds
+    (frag1, frag2, score) triples.
+    """
+    items1 = frags1.get_all(ftype)
+    items2 = frags2.get_all(ftype)
+    sigs1 = [content_signature(f) for f in items1]
+    sigs2 = [content_signature(f) for f in items2]
+
+    matched = []
+    used1, used2 = set(), set()
+    buckets = defaultdict(list)
+    for j, sig in enumerate(sigs2):
+        buckets[sig].append(j)
+    for i, sig in enumerate(sigs1):
+        cands = buckets.get(sig)
+        if cands:
+            j = cands.pop()
+            matched.append((items1[i], items2[j], 1.0))
+            used1.add(i)
+            used2.add(j)
+
+    rem1 = [i for i in range(len(items1)) if i not in used1]
+    rem2 = [j for j in range(len(items2)) if j not in used2]
+    if rem1 and rem2:
+        # cdist runs the bounded-window all-pairs scoring in rapidfuzz's
+        # parallel C++ kernel across all cores (workers=-1), so the $145
+        # 500-char prefixes are compared without any per-pair Python cost.
+        scores = process.cdist([sigs1[i] for i in rem1],
+                               [sigs2[j] for j in rem2],
+                               scorer=fuzz.ratio, dtype=np.float32,
+                               workers=-1, score_cutoff=_SCORE_CUTOFF)
+        for a, i in enumerate(rem1):
+            b = int(scores[a].argmax())
+            s = float(scores[a, b])
+            if s >= _SCORE_CUTOFF:
+                j = rem2[b]
+                matched.append((items1[i], items2[j], s / 100.0))
+                # Knock the claimed column out with one vectorized store
+                # instead of a per-candidate used-set test.
+                scores[:, b] = -1.0
+                used1.add(i)
+                used2.add(j)
+
+    unmatched1 = [items1[i] for i in range(len(items1)) if i not in used1]
+    unmatched2 = [items2[j] for j in range(len(items2)) if j not in used2]
+    return matched, unmatched1, unmatched2
+
+
+def format_value_compact(val, max_depth=2, max_len=60):
+    """Single-line preview of a value for diff output."""
+    val = unwrap_annotation(val)
+    if max_depth <= 0:
+        return "..."
+    if hasattr(val, "items"):
+        parts = ["{ "]
+        sep = ""
+        for k, v in itertools.islice(val.items(), 5):
+            parts.append(sep)
+            parts.append(_key_str(k))
+            parts.append(": ")
+            parts.append(format_value_compact(v, max_depth - 1, max_len // 2))
+            sep = ", "
+        if len(val) > 5:
+            parts.append(", ...+%d" % (len(val) - 5))
+        parts.append(" }")
+        result = "".join(parts)
+    elif isinstance(val, (list, tuple)):
+        parts = ["["]
+        sep = ""
+        for v in itertools.islice(val, 5):
+            parts.append(sep)
+            parts.append(format_value_compact(v, max_depth - 1, max_len // 2))
+            sep = ", "
+        if len(val) > 5:
+            parts.append(", ...+%d" % (len(val) - 5))
+        parts.append("]")
+        result = "".join(parts)
+    elif isinstance(val, (bytes, bytearray)):
+        result = "<%d bytes>" % len(val)
+    else:
+        result = str(val)
+    if len(result) > max_len:
+        return result[:max_len] + "..."
+    return result
+
+
+def iter_diff_values(val1, val2, path="", max_depth=5):
+    """Lazily yield (path, kind, left, right) diffs.
+
+    Being a generator, consumers cap the work by simply not pulling more —
+    the recursion below an unconsumed diff never happens, which replaces the
+    explicit budget ref-cell this used to thread through. Keys sort with
+    native string comparison at every level — set order would make the
+    output nondeterministic across runs — with a key=str fallback for the
+    rare mixed-type dict.
+    """
+    if val1 is val2 or val1 == val2 or max_depth <= 0:
+        return
+    val1 = unwrap_annotation(val1)
+    val2 = unwrap_annotation(val2)
+    if hasattr(val1, "keys") and hasattr(val2, "keys"):
+        all_keys = set(val1.keys()) | set(val2.keys())
+        try:
+            keys = sorted(all_keys)
+        except TypeError:
+            keys = sorted(all_keys, key=str)
+        for k in keys:
+            k_str = _key_str(k)
+            sub = path + "." + k_str if path else k_str
+            if k not in val1:
+                yield (sub, "added", None, val2[k])
+            elif k not in val2:
+                yield (sub, "removed", val1[k], None)
+            elif val1[k] is not val2[k] and val1[k] != val2[k]:
+                yield from iter_diff_values(val1[k], val2[k], sub,
+                                            max_depth - 1)
+    elif isinstance(val1, (list, tuple)) and isinstance(val2, (list, tuple)):
+        if len(val1) != len(val2):
+            yield (path, "length", len(val1), len(val2))
+        for i, (v1, v2) in enumerate(zip(val1, val2)):
+            if v1 is not v2 and v1 != v2:
+                yield from iter_diff_values(v1, v2, "%s[%d]" % (path, i),
+                                            max_depth - 1)
+    elif val1 != val2:  # unwrapping may have made the two sides equal
+        yield (path, "changed", val1, val2)
+
+
+def diff_values(val1, val2, path="", max_depth=5, limit=None):
+    """Structural diff as a list; see iter_diff_values."""
+    it = iter_diff_values(val1, val2, path, max_depth)
+    return list(it if limit is None else itertools.islice(it, limit))
+
+
+def print_fragment_diff(frag1, frag2, label=""):
+    """Print the differences between two matched fragments; returns whether
+    any were found."""
+    it = iter_diff_values(frag1.value, frag2.value)
+    shown = list(itertools.islice(it, 15))
+    if not shown:
+        return False
+    # Count (a bounded amount of) the tail without formatting it.
+    extra = sum(1 for _ in itertools.islice(it, 100))
+    count = "%d" % len(shown) if not extra else "%d+" % (len(shown) + extra)
+    print("  ~ %s %s: %s difference(s)"
+          % (label or sym(frag1.ftype), frag1.fid, count))
+    for path, kind, v1, v2 in shown:
+        if kind == "added":
+            print("      + %s = %s" % (path, format_value_compact(v2)))
+        elif kind == "removed":
+            print("      - %s = %s" % (path, format_value_compact(v1)))
+        else:
+            print("      ~ %s: %s -> %s"
+                  % (path, format_value_compact(v1), format_value_compact(v2)))
+    if extra:
+        print("      ... %d%s more" % (extra, "+" if extra == 100 else ""))
+    return True
+
+
+def analyze_styles(frags1, frags2):
+    print("\n== Styles ==")
+    styles1 = {get_style_name(f): f for f in frags1.get_all("$157")}
+    styles2 = {get_style_name(f): f for f in frags2.get_all("$157")}
+    only1 = sorted(set(styles1) - set(styles2))
+    only2 = sorted(set(styles2) - set(styles1))
+    if only1:
+        print("  only in ref: %s" % ", ".join(only1))
+    if only2:
+        print("  only in new: %s" % ", ".join(only2))
+    changed = 0
+    shared = sorted(set(styles1) & set(styles2))
+    for name in shared:
+        if value_hash(styles1[name]) != value_hash(styles2[name]):
+            print_fragment_diff(styles1[name], styles2[name], "style")
+            changed += 1
+    print("  %d shared style(s), %d changed" % (len(shared), changed))
+
+
+def analyze_sections(frags1, frags2):
+    print("\n== Sections ==")
+    secs1 = {get_section_name(f): f for f in frags1.get_all("$260")}
+    secs2 = {get_section_name(f): f for f in frags2.get_all("$260")}
+    only1 = sorted(set(secs1) - set(secs2))
+    only2 = sorted(set(secs2) - set(secs1))
+    if only1:
+        print("  only in ref: %s" % ", ".join(only1))
+    if only2:
+        print("  only in new: %s" % ", ".join(only2))
+    changed = 0
+    shared = sorted(set(secs1) & set(secs2))
+    for name in shared:
+        s1 = secs1[name]
+        s2 = secs2[name]
+        t1 = s1.value.get("$141") or []
+        t2 = s2.value.get("$141") or []
+        if len(t1) != len(t2):
+            print("  ~ section %s: %d vs %d page template(s)"
+                  % (name, len(t1), len(t2)))
+            changed += 1
+        elif value_hash(s1) != value_hash(s2):
+            if print_fragment_diff(s1, s2, "section"):
+                changed += 1
+    print("  %d shared section(s), %d changed" % (len(shared), changed))
+
+
+def analyze_storylines(frags1, frags2):
+    print("\n== Storylines ==")
+    matched, un1, un2 = match_fragments_by_content(frags1, frags2, "$259")
+    for frag in un1:
+        print("  - unmatched in ref: %s (%d items)"
+              % (frag.fid, len(frag.value.get("$146", []))))
+    for frag in un2:
+        print("  + unmatched in new: %s (%d items)"
+              % (frag.fid, len(frag.value.get("$146", []))))
+    changed = 0
+    for frag1, frag2, score in matched:
+        content1 = frag1.value.get("$146") or []
+        content2 = frag2.value.get("$146") or []
+        types1 = Counter(map(_ctype, content1))
+        types2 = Counter(map(_ctype, content2))
+        if len(content1) != len(content2) or types1 != types2:
+            changed += 1
+            print("  ~ %s <-> %s (%.0f%% match): %d vs %d items"
+                  % (frag1.fid, frag2.fid, score * 100,
+                     len(content1), len(content2)))
+            for t in sorted(set(types1) | set(types2), key=str):
+                if types1[t] != types2[t]:
+                    print("      %s: %d vs %d" % (sym(t), types1[t], types2[t]))
+    print("  %d matched storyline(s), %d changed" % (len(matched), changed))
+
+
+def _partition_anchors(anchors):
+    """One pass: external URL set plus internal position list."""
+    ext, internal = set(), []
+    for frag in anchors:
+        v = frag.value
+        if not hasattr(v, "get"):
+            continue
+        g = v.get
+        url = g("$186")
+        if url is not None:
+            ext.add(str(url))
+            continue
+        pos = g("$183")
+        if pos is not None:
+            internal.append(pos)
+    return ext, internal
+
+
+def analyze_anchors(frags1, frags2):
+    print("\n== Anchors ==")
+    ext1, int1 = _partition_anchors(frags1.get_all("$266"))
+    ext2, int2 = _partition_anchors(frags2.get_all("$266"))
+    print("  ref: %d external, %d internal" % (len(ext1), len(int1)))
+    print("  new: %d external, %d internal" % (len(ext2), len(int2)))
+    missing = sorted(ext1 - ext2)
+    added = sorted(ext2 - ext1)
+    for url in missing:
+        print("  - %s" % url)
+    for url in added:
+        print("  + %s" % url)
+    if not missing and not added:
+        print("  external URLs identical")
+
+
+def analyze_text_content(frags1, frags2):
+    print("\n== Text ==")
+    texts1 = [get_text_content(f) for f in frags1.get_all("$145")]
+    texts2 = [get_text_content(f) for f in frags2.get_all("$145")]
+    total1 = sum(len(t) for t in texts1)
+    total2 = sum(len(t) for t in texts2)
+    print("  ref: %d chars in %d fragment(s)" % (total1, len(texts1)))
+    print("  new: %d chars in %d fragment(s)" % (total2, len(texts2)))
+    full1 = " ".join(texts1)
+    full2 = " ".join(texts2)
+    b1 = full1.encode("utf-8")
+    b2 = full2.encode("utf-8")
+    if hashlib.blake2b(b1).digest() == hashlib.blake2b(b2).digest():
+        # One hashing pass beats a char-by-char == walk on matching text.
+        print("  text content identical")
+        return
+    a1 = np.frombuffer(b1, dtype=np.uint8)
+    a2 = np.frombuffer(b2, dtype=np.uint8)
+    n = min(a1.size, a2.size)
+    neq = a1[:n] != a2[:n]
+    if neq.any():
+        # First mismatching byte, found in vectorized C; map it back to a
+        # character offset for the context window.
+        i = int(np.argmax(neq))
+        ci = len(b1[:i].decode("utf-8", errors="ignore"))
+        print("  first difference at char %d:" % ci)
+        print("    ref: ...%r" % full1[max(0, ci - 20):ci + 40])
+        print("    new: ...%r" % full2[max(0, ci - 20):ci + 40])
+    else:
+        print("  one text is a prefix of the other (diverges at char %d)"
+              % min(len(full1), len(full2)))
+    sim = similarity(full1, full2)
+    print("  overall similarity: %.1f%%" % (sim * 100))
+
+
+def smart_diff(file1, file2):
+    # The two loads are independent read+parse work; overlap them.
+    with ThreadPoolExecutor(2) as ex:
+        fut1 = ex.submit(load_kfx, file1)
+        fut2 = ex.submit(load_kfx, file2)
+        frags1, method1 = fut1.result()
+        frags2, method2 = fut2.result()
+    print("ref: %s, %d fragments (%s)"
+          % (file1, len(frags1.all_fragments), method1))
+    print("new: %s, %d fragments (%s)"
+          % (file2, len(frags2.all_fragments), method2))
+
+    print("\n== Fragment counts ==")
+    c1 = Counter(f.ftype for f in frags1.all_fragments)
+    c2 = Counter(f.ftype for f in frags2.all_fragments)
+    for ftype in sorted(set(c1) | set(c2)):
+        a, b = c1[ftype], c2[ftype]
+        marker = "" if a == b else "  <--"
+        print("  %s: %d vs %d%s" % (sym(ftype), a, b, marker))
+
+    analyze_styles(frags1, frags2)
+    analyze_sections(frags1, frags2)
+    analyze_storylines(frags1, frags2)
+    analyze_anchors(frags1, frags2)
+    analyze_text_content(frags1, frags2)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Content-based diff of two KFX files")
+    parser.add_argument("file1", help="reference KFX")
+    parser.add_argument("file2", help="KFX to compare against the reference")
+    args = parser.parse_args()
+    smart_diff(args.file1, args.file2)
+
+
+if __name__ == "__main__":
+    main()
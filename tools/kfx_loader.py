@@ -0,0 +1,88 @@
+"""Shared KFX fragment loading for the tools/ scripts.
+
+Wraps the two ways we can get at a book's fragments — kfxlib's full decoder
+when a checkout is around, kfxdump's manual container parser otherwise — in
+one call that hands back a uniform fragment list, so the section/diff tools
+don't care which path produced it.
+"""
+
+import os
+import sys
+
+KFXLIB_CANDIDATES = ["~/code/kfx/kfx_input", "~/code/kfx/kfx_output", "~/code/kfx"]
+
+
+class Fragment:
+    __slots__ = ("ftype", "fid", "value", "byte_length")
+
+    def __init__(self, ftype, fid, value):
+        self.ftype = ftype
+        self.fid = fid
+        self.value = value
+        # Payload size for raw-media fragments, recorded once at wrap time so
+        # consumers can report sizes without going back through .value.
+        self.byte_length = len(value) if isinstance(value, (bytes, bytearray)) else 0
+
+
+class FragmentList:
+    """A book's fragments with simple by-type access."""
+
+    def __init__(self, fragments):
+        self.all_fragments = fragments
+
+    def get_all(self, ftype):
+        return [f for f in self.all_fragments if f.ftype == ftype]
+
+    def get(self, ftype, fid):
+        for f in self.all_fragments:
+            if f.ftype == ftype and f.fid == fid:
+                return f
+        return None
+
+    def count(self, ftype):
+        return len(self.get_all(ftype))
+
+    def types(self):
+        return {f.ftype for f in self.all_fragments}
+
+
+def unwrap_annotation(val):
+    """Strip an Ion annotation wrapper, from either decode path."""
+    if hasattr(val, "annotations") and hasattr(val, "value"):
+        return val.value
+    return val
+
+
+def load_kfx(path, types=None):
+    """Load a book's fragments; returns (FragmentList, method).
+
+    method is "kfxlib" or "manual", mostly for display — the fragments look
+    the same either way. When `types` (a set of "$NNN" strings) is given,
+    only those fragment types are kept, and the manual parser skips decoding
+    everything else where it can.
+    """
+    for candidate in KFXLIB_CANDIDATES:
+        root = os.path.expanduser(candidate)
+        if os.path.isdir(root):
+            sys.path.insert(0, root)
+            break
+    try:
+        from kfxlib import yj_book
+    except ImportError:
+        from kfxdump import load_kfx_manual
+        if types is not None and len(types) == 1:
+            # The manual parser filters from the container index, before any
+            # payload is decoded.
+            store = load_kfx_manual(path, want_type=next(iter(types)))
+        else:
+            store = load_kfx_manual(path)
+        fragments = [Fragment(f.ftype, f.fid, f.value) for f in store
+                     if types is None or f.ftype in types]
+        return FragmentList(fragments), "manual"
+
+    book = yj_book.YJ_Book(path)
+    book.decode_book()
+    fragments = [Fragment(str(f.ftype), str(f.fid), f.value)
+                 for f in book.fragments
+                 if types is None or str(f.ftype) in types]
+    return FragmentList(fragments), "kfxlib"
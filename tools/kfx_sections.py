@@ -0,0 +1,491 @@
+#!/usr/bin/env -S uv run --script
+# /// script
+# requires-python = ">=3.10"
+# dependencies = []
+# ///
+"""Per-section report of a KFX book: metadata, styles, content, position maps,
+navigation, anchors, resources and capabilities, one readable block each.
+
+Where kfxdump prints raw fragment trees, this summarizes — counts, names and
+one-line previews — so two builds of the same book can be eyeballed quickly.
+"""
+import argparse
+import functools
+import hashlib
+import json
+import os
+import pickle
+import sys
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from kfx_loader import Fragment, FragmentList, load_kfx, unwrap_annotation
+from kfx_symbols import format_symbol
+
+
+_LAYOUT_KEYS = frozenset({"$56", "$57", "$66", "$67", "$42", "$43", "$44",
+                          "$45", "$16", "$18", "$19"})
+_TEXT_KEYS = frozenset({"$47", "$48", "$49", "$50", "$51", "$52", "$53",
+                        "$54", "$55"})
+_CATEGORY = {k: "layout" for k in _LAYOUT_KEYS} | {k: "text" for k in _TEXT_KEYS}
+
+
+class Out:
+    """Collects output lines and writes them to stdout in one go, so the
+    dumpers aren't paying a syscall per line."""
+
+    def __init__(self):
+        self.buf = []
+
+    def p(self, s=""):
+        self.buf.append(s)
+
+    def flush(self):
+        text = "\n".join(self.buf) + "\n"
+        self.buf = []
+        if sys.stdout.isatty():
+            # Keep the TextIOWrapper path on terminals so newline translation
+            # and the console encoding still apply.
+            sys.stdout.write(text)
+            return
+        sys.stdout.flush()
+        os.write(sys.stdout.fileno(), text.encode("utf-8", errors="replace"))
+
+
+class CachedFrags:
+    """Fragments pre-bucketed by type, so every get_all/count in the dumpers
+    is a dict hit instead of another walk over the whole list."""
+
+    def __init__(self, frags):
+        buckets = defaultdict(list)
+        for f in frags.all_fragments:
+            buckets[str(f.ftype)].append(f)
+        self.all_fragments = frags.all_fragments
+        self.buckets = dict(buckets)
+        self.counts = {t: len(fs) for t, fs in self.buckets.items()}
+
+    def get_all(self, ftype):
+        return self.buckets.get(ftype, [])
+
+    def get(self, ftype, fid):
+        for f in self.buckets.get(ftype, []):
+            if f.fid == fid:
+                return f
+        return None
+
+    def count(self, ftype):
+        return self.counts.get(ftype, 0)
+
+    def types(self):
+        return self.counts.keys()
+
+
+@functools.lru_cache(maxsize=None)
+def sym(s):
+    return format_symbol(s)
+
+
+def _trunc(s, n=60):
+    return f"{s[:n]}..." if isinstance(s, str) and len(s) > n else s
+
+
+def _fmt_dict(val, out, depth):
+    out.append("{ ")
+    first = True
+    for k, v in val.items():
+        if not first:
+            out.append(", ")
+        first = False
+        out.append(sym(k))
+        out.append(": ")
+        _format_value(v, out, depth + 1)
+    out.append(" }")
+
+
+def _fmt_seq(val, out, depth):
+    out.append("[")
+    for i, v in enumerate(val):
+        if i:
+            out.append(", ")
+        _format_value(v, out, depth + 1)
+    out.append("]")
+
+
+def _fmt_bytes(val, out, depth):
+    out.append("<%d bytes>" % len(val))
+
+
+def _fmt_str(val, out, depth):
+    out.append(repr(_trunc(val, 50)))
+
+
+_FMT = {dict: _fmt_dict, list: _fmt_seq, tuple: _fmt_seq,
+        bytes: _fmt_bytes, bytearray: _fmt_bytes, str: _fmt_str}
+
+
+def _format_value(val, out, depth=0):
+    if depth > 3:
+        out.append("...")
+        return
+    fn = _FMT.get(type(val))
+    if fn is not None:
+        fn(val, out, depth)
+        return
+    # Subclasses (IonSymbol) and wrapper objects take the slow path.
+    if isinstance(val, str):
+        _fmt_str(val, out, depth)
+    elif hasattr(val, "items"):
+        _fmt_dict(val, out, depth)
+    elif hasattr(val, "value"):  # annotation wrapper
+        _format_value(val.value, out, depth)
+    else:
+        out.append(repr(val))
+
+
+def format_value(val):
+    """One-line compact rendering of a fragment value."""
+    out = []
+    _format_value(val, out)
+    return "".join(out)
+
+
+def dump_metadata(frags, out, limit=None):
+    out.p("== Metadata ==")
+    for frag in frags.get_all("$490"):
+        for group in frag.value.get("$491", []):
+            out.p("  [%s]" % str(group.get("$495", "?")))
+            for item in group.get("$258", []):
+                k = item.get("$492", "?")
+                k_str = k if type(k) is str else str(k)
+                out.p("    %s: %s" % (k_str, _trunc(item.get("$307", ""))))
+    for frag in frags.get_all("$538"):
+        orders = frag.value.get("$169", [])
+        out.p("  document_data: %d reading order(s)" % len(orders))
+        for ro in orders:
+            out.p("    %s: %d sections"
+                  % (str(ro.get("$178", "?")), len(ro.get("$170", []))))
+
+
+def dump_styles(frags, out, limit=None):
+    styles = frags.get_all("$157")
+    out.p("== Styles (%d) ==" % len(styles))
+    for i, frag in enumerate(styles if limit is None else styles[:limit]):
+        counts = {"layout": 0, "text": 0, "other": 0}
+        props = frag.value
+        for k in props:
+            k_str = k if type(k) is str else str(k)
+            counts[_CATEGORY.get(k_str, "other")] += 1
+        layout, text, other = counts["layout"], counts["text"], counts["other"]
+        out.p("  [%d] %s: %d props (%d layout, %d text, %d other)"
+              % (i, frag.fid, len(props), layout, text, other))
+        out.p("      %s" % format_value(props))
+    if limit and len(styles) > limit:
+        out.p("  ... (showing first %d)" % limit)
+
+
+def _count_chars(items):
+    """Characters in a $146 content list (plain strings, or {$143, $144}
+    entry structs in older streams, where $144 is the integer length)."""
+    total = 0
+    for i in items:
+        if isinstance(i, str):
+            total += len(i)
+        elif hasattr(i, "get"):
+            length = i.get("$144", 0)
+            if isinstance(length, int):
+                total += length
+    return total
+
+
+def dump_content(frags, out, limit=None):
+    out.p("== Content ==")
+    sections = frags.get_all("$260")
+    out.p("Sections (%d):" % len(sections))
+    for i, frag in enumerate(sections if limit is None else sections[:limit]):
+        g = frag.value.get
+        out.p("  [%d] %s: %d page template(s)"
+              % (i, str(g("$174", frag.fid)), len(g("$141", []))))
+
+    storylines = frags.get_all("$259")
+    out.p("Storylines (%d):" % len(storylines))
+    for i, frag in enumerate(storylines if limit is None else storylines[:limit]):
+        content = frag.value.get("$146", [])
+        types = Counter(str(unwrap_annotation(item).get("$159", "?"))
+                        for item in content)
+        summary = ", ".join("%s x%d" % (sym(t), n)
+                            for t, n in sorted(types.items()))
+        out.p("  [%d] %s: %d items (%s)"
+              % (i, str(frag.value.get("$176", frag.fid)), len(content), summary))
+
+    text_frags = frags.get_all("$145")
+    out.p("Text fragments (%d):" % len(text_frags))
+    for i, frag in enumerate(text_frags if limit is None else text_frags[:limit]):
+        content = frag.value.get("$146", [])
+        chars = _count_chars(content)
+        preview = ""
+        for item in content:
+            if isinstance(item, str) and item.strip():
+                preview = item
+                break
+        out.p("  [%d] %s: %d strings, %d chars  %r"
+              % (i, frag.fid, len(content), chars, _trunc(preview, 80)))
+    total_chars = sum(_count_chars(f.value.get("$146", ())) for f in text_frags)
+    out.p("Total text: %d chars" % total_chars)
+
+
+_SECTION_ROW = "  [%d] section=%s eids=%d"
+_PID_ROW = "  [%d] PID=%s EID=%s"
+_LOC_ROW = "  [%d] EID=%s offset=%s length=%s"
+
+
+def dump_position(frags, out, limit=None):
+    out.p("== Position maps ==")
+    for frag in frags.get_all("$264"):
+        entries = frag.value if isinstance(frag.value, list) else []
+        out.p("Position map: %d section(s)" % len(entries))
+        for i, entry in enumerate(entries if limit is None else entries[:limit]):
+            g = entry.get
+            out.p(_SECTION_ROW % (i, g("$174", "?"), len(g("$181", []))))
+    for frag in frags.get_all("$265"):
+        entries = frag.value if isinstance(frag.value, list) else []
+        out.p("Position-id map: %d entries" % len(entries))
+        for i, entry in enumerate(entries if limit is None else entries[:limit]):
+            g = entry.get
+            out.p(_PID_ROW % (i, g("$184", "?"), g("$185", "?")))
+    for frag in frags.get_all("$550"):
+        locations = []
+        for group in (frag.value if isinstance(frag.value, list) else []):
+            locations.extend(group.get("$182", []))
+        out.p("Location map: %d locations" % len(locations))
+        for i, entry in enumerate(locations if limit is None else locations[:limit]):
+            g = entry.get
+            out.p(_LOC_ROW % (i, g("$155", "?"), g("$143", 0), g("$144", 0)))
+
+
+def _count_nav_units(entries):
+    n = 0
+    for entry in entries:
+        entry = unwrap_annotation(entry)
+        if hasattr(entry, "items"):
+            n += 1
+            n += _count_nav_units(entry.get("$247", []))
+    return n
+
+
+def dump_navigation(frags, out, limit=None):
+    out.p("== Navigation ==")
+    for frag in frags.get_all("$389"):
+        for ro in (frag.value if isinstance(frag.value, list) else []):
+            ro = unwrap_annotation(ro)
+            containers = ro.get("$392", [])
+            out.p("Reading order %s: %d nav container(s)"
+                  % (str(ro.get("$178", "?")), len(containers)))
+            for i, cont in enumerate(containers if limit is None
+                                     else containers[:limit]):
+                cont = unwrap_annotation(cont)
+                entries = cont.get("$247", [])
+                out.p("  [%d] %s: %d entries (%d total units)"
+                      % (i, sym(str(cont.get("$235", cont.get("$240", "?")))),
+                         len(entries), _count_nav_units(entries)))
+                for entry in entries[:5]:
+                    entry = unwrap_annotation(entry)
+                    label = str(entry.get("$241", {}).get("$244", ""))
+                    out.p("      - %s" % _trunc(label, 40))
+
+
+def dump_anchors(frags, out, limit=None):
+    anchors = frags.get_all("$266")
+    internal, external = [], []
+    for f in anchors:
+        g = f.value.get
+        aid = str(g("$180", "?"))
+        ext = g("$186")
+        if ext is not None:
+            external.append((aid, ext))
+            continue
+        pos = g("$183")
+        if pos is not None:
+            internal.append((aid, pos.get("$155", "?"), pos.get("$143", 0)))
+    out.p("== Anchors (%d) ==" % len(anchors))
+    out.p("Internal (%d):" % len(internal))
+    for aid, eid, offset in (internal if limit is None else internal[:limit]):
+        out.p("  %s -> EID=%s offset=%s" % (aid, eid, offset))
+    out.p("External (%d):" % len(external))
+    for aid, uri in (external if limit is None else external[:limit]):
+        out.p("  %s -> %s" % (aid, _trunc(str(uri), 50)))
+
+
+def dump_resources(frags, out, limit=None):
+    resources = frags.get_all("$164")
+    out.p("== Resources (%d external) ==" % len(resources))
+    for frag in (resources if limit is None else resources[:limit]):
+        g = frag.value.get
+        out.p("  %s: format=%s location=%s %sx%s"
+              % (str(g("$175", frag.fid)), sym(str(g("$161", "?"))),
+                 g("$165", "?"), g("$422", "?"), g("$423", "?")))
+    raws = frags.get_all("$417")
+    out.p("Raw media (%d):" % len(raws))
+    for frag in (raws if limit is None else raws[:limit]):
+        out.p("  %s: %d bytes" % (frag.fid, getattr(frag, "byte_length", 0)))
+    total_bytes = sum(getattr(f, "byte_length", 0) for f in raws)
+    out.p("Total raw media: %d bytes" % total_bytes)
+
+
+def dump_capabilities(frags, out, limit=None):
+    out.p("== Capabilities ==")
+    for frag in frags.get_all("$585"):
+        feats = frag.value.get("$590", [])
+        out.p("Content features (%d):" % len(feats))
+        for feat in feats:
+            feat = unwrap_annotation(feat)
+            out.p("  %s/%s" % (feat.get("$586", ""), str(feat.get("$492", "?"))))
+    for frag in frags.get_all("$593"):
+        out.p("Format capabilities: %s" % format_value(frag.value))
+
+
+SECTION_TYPES = {
+    "metadata": {"$490", "$538"},
+    "styles": {"$157"},
+    "content": {"$260", "$259", "$145"},
+    "position": {"$264", "$265", "$550"},
+    "navigation": {"$389"},
+    "anchors": {"$266"},
+    "resources": {"$164", "$417"},
+    "capabilities": {"$585", "$593"},
+}
+
+SECTION_FUNCS = [
+    ("metadata", dump_metadata),
+    ("styles", dump_styles),
+    ("content", dump_content),
+    ("position", dump_position),
+    ("navigation", dump_navigation),
+    ("anchors", dump_anchors),
+    ("resources", dump_resources),
+    ("capabilities", dump_capabilities),
+]
+
+
+def _cache_path(path, section):
+    st = os.stat(path)
+    key = hashlib.sha1(("%s:%d:%d:%s" % (os.path.abspath(path), st.st_mtime_ns,
+                                         st.st_size, section)).encode()).hexdigest()
+    return os.path.join(os.path.expanduser("~/.cache"), "kfx_sections",
+                        key + ".pkl")
+
+
+def _read_cache(cache_file):
+    try:
+        with open(cache_file, "rb") as fh:
+            rows, method = pickle.load(fh)
+    except (OSError, pickle.PickleError, EOFError, ValueError):
+        return None
+    fragments = []
+    for ftype, fid, value, byte_length in rows:
+        frag = Fragment(ftype, fid, value)
+        frag.byte_length = byte_length
+        fragments.append(frag)
+    return FragmentList(fragments), method
+
+
+def _write_cache(cache_file, frags, method):
+    # Raw media bodies are dropped (the dumpers only use byte_length) so the
+    # cache stays small even for image-heavy books.
+    rows = [(f.ftype, f.fid,
+             "<%d bytes>" % f.byte_length
+             if isinstance(f.value, (bytes, bytearray)) else f.value,
+             f.byte_length)
+            for f in frags.all_fragments]
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp = cache_file + ".tmp"
+        with open(tmp, "wb") as fh:
+            pickle.dump((rows, method), fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+    except OSError:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a KFX book by section")
+    parser.add_argument("file", help="KFX file")
+    parser.add_argument("--section", default="all",
+                        choices=["all"] + [name for name, _ in SECTION_FUNCS])
+    parser.add_argument("--limit", type=int, default=None,
+                        help="cap items shown per list")
+    parser.add_argument("--verbose", action="store_true",
+                        help="also print the fragment type histogram")
+    parser.add_argument("--format", choices=["text", "json"], default="text",
+                        help="json skips all pretty-printing for piping")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always re-parse the container")
+    args = parser.parse_args()
+
+    wanted = None if args.section == "all" else SECTION_TYPES[args.section]
+    cached = None
+    cache_file = None
+    if not args.no_cache:
+        cache_file = _cache_path(args.file, args.section)
+        cached = _read_cache(cache_file)
+    if cached is not None:
+        frags, method = cached
+        method += ", cached"
+    else:
+        frags, method = load_kfx(args.file, types=wanted)
+        if cache_file is not None:
+            _write_cache(cache_file, frags, method)
+    frags = CachedFrags(frags)
+
+    if args.format == "json":
+        # Raw fragment values keyed by section/type, symbols left as "$NNN" —
+        # no truncation, headers or symbol naming, the consumer decodes.
+        sections = ([name for name, _ in SECTION_FUNCS]
+                    if args.section == "all" else [args.section])
+        payload = {
+            name: {
+                t: [[f.fid,
+                     "<%d bytes>" % f.byte_length
+                     if isinstance(f.value, (bytes, bytearray)) else f.value]
+                    for f in frags.get_all(t)]
+                for t in sorted(SECTION_TYPES[name])
+            }
+            for name in sections
+        }
+        try:
+            import orjson
+            sys.stdout.buffer.write(orjson.dumps(
+                payload, default=str, option=orjson.OPT_NON_STR_KEYS))
+        except ImportError:
+            json.dump(payload, sys.stdout, separators=(",", ":"), default=str)
+        sys.stdout.write("\n")
+        return
+
+    out = Out()
+    out.p("%s: %d fragments (%s)" % (args.file, len(frags.all_fragments), method))
+    if args.verbose:
+        out.p("Fragment summary:")
+        for ftype in sorted(frags.types()):
+            out.p("  %s: %d" % (sym(ftype), frags.count(ftype)))
+    selected = [fn for name, fn in SECTION_FUNCS if args.section in ("all", name)]
+    if len(selected) > 1:
+        # The dumpers only read the shared buckets, so they can run
+        # concurrently, each into its own buffer; results are stitched back
+        # together in the fixed section order.
+        def run(fn):
+            section_out = Out()
+            fn(frags, section_out, args.limit)
+            return section_out.buf
+
+        with ThreadPoolExecutor(max_workers=len(selected)) as ex:
+            for fut in [ex.submit(run, fn) for fn in selected]:
+                out.p("")
+                out.buf.extend(fut.result())
+    else:
+        for fn in selected:
+            out.p("")
+            fn(frags, out, args.limit)
+    out.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,527 @@
+#!/usr/bin/env -S uv run --script
+# /// script
+# dependencies = [
+#     "msgpack",
+#     "numpy",
+#     "rapidfuzz",
+#     "xxhash",
+# ]
+# ///
+"""Quick regression report between two KFX builds.
+
+Where kfx_diff.py walks every changed fragment, this answers the faster
+question "did this refactor change the book?": per-type fragment counts with
+pass/fail markers, style signature drift, anchor targets, metadata values, and
+an overall text-similarity score. Green check marks all the way down means the
+builds are interchangeable.
+
+Usage: kfx_smart_diff.py old.kfx new.kfx
+"""
+
+import argparse
+import hashlib
+import io
+import mmap
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
+import msgpack
+import numpy as np
+import xxhash
+
+# Best available similarity backend: rapidfuzz's C core, then
+# python-Levenshtein (same values as SequenceMatcher.ratio, but GPLv2 — fine
+# to use, mind it when vendoring), then stdlib difflib as the always-there
+# fallback for bare interpreters.
+try:
+    from rapidfuzz.fuzz import ratio as _rf_ratio
+
+    def _sim(s1, s2):
+        return _rf_ratio(s1, s2) / 100.0
+except ImportError:
+    try:
+        from Levenshtein import ratio as _sim
+    except ImportError:
+        from difflib import SequenceMatcher
+
+        def _sim(s1, s2):
+            return SequenceMatcher(None, s1, s2).ratio()
+
+from kfx_loader import load_kfx
+from kfx_symbols import format_symbol
+from kfxdump import IonAnnotation as _ManualAnnotation
+
+# The two decode paths wrap annotated values in different classes; collect
+# whichever are importable so unwrapping is one isinstance check instead of
+# two hasattr probes on every node — including the leaves that never match.
+try:
+    from kfxlib.ion import IonAnnotation as _KfxlibAnnotation
+except ImportError:
+    _ANNOTATION_TYPES = (_ManualAnnotation,)
+else:
+    _ANNOTATION_TYPES = (_ManualAnnotation, _KfxlibAnnotation)
+
+
+def _unwrap(val, _types=_ANNOTATION_TYPES):
+    return val.value if isinstance(val, _types) else val
+
+
+if sys.stdout.isatty():
+    GREEN, YELLOW, RED, RESET = "\033[32m", "\033[33m", "\033[31m", "\033[0m"
+else:
+    GREEN = YELLOW = RED = RESET = ""
+
+
+# Both decode paths hand back concrete containers (kfxlib's Ion structs
+# subclass dict/list), so cheap isinstance checks replace hasattr protocol
+# sniffing on every node.
+_DICT_TYPES = (dict,)
+_LIST_TYPES = (list, tuple)
+
+# Sentinel for dict.get when None is a legal stored value.
+_MISSING = object()
+
+# Style keys that identify rather than describe a style.
+_STYLE_SKIP_KEYS = frozenset(("$173", "$176", "version"))
+
+
+def _mark(diff, threshold=10):
+    """Pass/fail marker for a count delta: ✓ when equal, colored delta when not."""
+    if diff == 0:
+        return "%s✓%s" % (GREEN, RESET)
+    color = YELLOW if abs(diff) < threshold else RED
+    return "%s%+d%s" % (color, diff, RESET)
+
+
+@lru_cache(maxsize=2048)
+def sym(s):
+    return format_symbol(s)
+
+
+def similarity(s1, s2):
+    """Similarity of two strings in [0, 1]."""
+    if not s1 and not s2:
+        return 1.0
+    if not s1 or not s2:
+        return 0.0
+    return _sim(s1, s2)
+
+
+def extract_pure_text(value):
+    """All the plain strings reachable under `value`, in document order.
+
+    Symbol strings ("$NNN") are structure, not prose, and are skipped.
+    """
+    texts = []
+    ua = _unwrap
+    # Explicit stack instead of recursion; children are pushed reversed so
+    # LIFO popping keeps document order.
+    stack = [value]
+    while stack:
+        val = ua(stack.pop())
+        if isinstance(val, str):
+            if not val.startswith("$"):
+                texts.append(val)
+        elif isinstance(val, _DICT_TYPES):
+            stack.extend(reversed(list(val.values())))
+        elif isinstance(val, _LIST_TYPES):
+            stack.extend(reversed(val))
+    return texts
+
+
+# Fragments are analyzed more than once per run; the cache is cleared
+# wholesale when it grows past the cap rather than tracking LRU order.
+_PROPS_CACHE = {}
+_CACHE_CAP = 4096
+
+
+def get_style_properties(frag):
+    """The comparable properties of a style fragment, minus its identity keys."""
+    props = _PROPS_CACHE.get(id(frag))
+    if props is not None:
+        return props
+    val = _unwrap(frag.value)
+    if not isinstance(val, _DICT_TYPES):
+        return {}
+    props = {}
+    for k, v in val.items():
+        # Symbol keys are str subclasses and hash/compare as their text, so
+        # only genuinely non-str keys need the str() round trip.
+        k_str = k if isinstance(k, str) else str(k)
+        if k_str in _STYLE_SKIP_KEYS:
+            continue
+        props[k_str] = v
+    if len(_PROPS_CACHE) > _CACHE_CAP:
+        _PROPS_CACHE.clear()
+    _PROPS_CACHE[id(frag)] = props
+    return props
+
+
+class _Sig(bytes):
+    """A signature digest that is its own hash.
+
+    The blake2b digest is already uniformly distributed, so set operations on
+    signatures can read the hash straight out of the first eight bytes
+    instead of running SipHash over them.
+    """
+
+    __slots__ = ()
+
+    def __hash__(self):
+        return int.from_bytes(self[:8], "little")
+
+
+def props_signature(props):
+    """An 8-byte hash signature for a style's property dict.
+
+    msgpack serializes the nested values at C speed and blake2b collapses the
+    result to a fixed-size key, so signature sets hash and compare tiny bytes
+    objects instead of tuples of truncated strings. Items are sorted first so
+    the signature is independent of source-file key order.
+    """
+    packed = msgpack.packb(sorted(props.items()), default=str, use_bin_type=True)
+    return _Sig(hashlib.blake2b(packed, digest_size=8).digest())
+
+
+def format_value_compact(val, max_depth=3, max_len=200):
+    """One-line rendering of an Ion value for report rows, capped at max_len."""
+    parts = []
+    _format_into(val, max_depth, parts, [max_len])
+    return "".join(parts)
+
+
+def _format_into(val, depth, parts, budget):
+    """Append the rendering of `val` to `parts`, spending from `budget`.
+
+    `budget` is a one-element list of remaining characters; once it goes
+    negative every branch bails with "..." instead of formatting subtrees
+    that would be thrown away anyway.
+    """
+    if budget[0] <= 0:
+        parts.append("...")
+        return
+    val = _unwrap(val)
+    if depth <= 0:
+        parts.append("...")
+        return
+    if isinstance(val, _DICT_TYPES):
+        parts.append("{")
+        first = True
+        for k, v in val.items():
+            if not first:
+                parts.append(", ")
+            first = False
+            if budget[0] <= 0:
+                parts.append("...")
+                break
+            key = "%s: " % sym(str(k))
+            parts.append(key)
+            budget[0] -= len(key)
+            _format_into(v, depth - 1, parts, budget)
+        parts.append("}")
+    elif isinstance(val, _LIST_TYPES):
+        parts.append("[")
+        first = True
+        for v in val:
+            if not first:
+                parts.append(", ")
+            first = False
+            if budget[0] <= 0:
+                parts.append("...")
+                break
+            _format_into(v, depth - 1, parts, budget)
+        parts.append("]")
+    else:
+        if isinstance(val, str):
+            out = sym(val) if val.startswith("$") else repr(val)
+        elif isinstance(val, (bytes, bytearray)):
+            out = "<%d bytes>" % len(val)
+        else:
+            out = str(val)
+        remaining = budget[0]
+        if len(out) > remaining:
+            out = out[:remaining] + "..."
+        parts.append(out)
+        budget[0] -= len(out)
+
+
+def analyze_styles(by1, by2, out):
+    p = partial(print, file=out)
+    p()
+    p("=== Styles ===")
+    styles1 = by1.get("$157", ())
+    styles2 = by2.get("$157", ())
+    p("  %d vs %d style fragments" % (len(styles1), len(styles2)))
+
+    # Only a count and one representative per signature are ever displayed,
+    # so don't keep every duplicate fragment alive in a list.
+    sigs1 = {}
+    for frag in styles1:
+        entry = sigs1.setdefault(props_signature(get_style_properties(frag)), [0, frag])
+        entry[0] += 1
+    sigs2 = {}
+    for frag in styles2:
+        entry = sigs2.setdefault(props_signature(get_style_properties(frag)), [0, frag])
+        entry[0] += 1
+
+    shared = set(sigs1) & set(sigs2)
+    only1 = set(sigs1) - set(sigs2)
+    only2 = set(sigs2) - set(sigs1)
+    if not only1 and not only2:
+        p("  %s✓%s all %d property signatures shared" % (GREEN, RESET, len(shared)))
+        return
+    p("  %d signatures shared" % len(shared))
+    if only1:
+        p("  %s%d signatures only in file1:%s" % (RED, len(only1), RESET))
+        for sig in sorted(only1)[:3]:
+            p("    %s" % format_value_compact(sigs1[sig][1].value))
+    if only2:
+        p("  %s%d signatures only in file2:%s" % (RED, len(only2), RESET))
+        for sig in sorted(only2)[:3]:
+            p("    %s" % format_value_compact(sigs2[sig][1].value))
+
+
+def analyze_sections(by1, by2, out):
+    p = partial(print, file=out)
+    p()
+    p("=== Sections ===")
+    secs1 = by1.get("$260", ())
+    secs2 = by2.get("$260", ())
+    p("  %d vs %d sections  %s"
+      % (len(secs1), len(secs2), _mark(len(secs2) - len(secs1))))
+
+    def names(secs):
+        found = set()
+        for frag in secs:
+            val = _unwrap(frag.value)
+            if isinstance(val, _DICT_TYPES):
+                found.add(str(val.get("$174", frag.fid)))
+        return found
+
+    names1 = names(secs1)
+    names2 = names(secs2)
+    for name in sorted(names1 - names2):
+        p("  %sonly in file1: %s%s" % (RED, name, RESET))
+    for name in sorted(names2 - names1):
+        p("  %sonly in file2: %s%s" % (RED, name, RESET))
+
+
+def analyze_anchors(by1, by2, out):
+    p = partial(print, file=out)
+    p()
+    p("=== Anchors ===")
+    anchors1 = by1.get("$266", ())
+    anchors2 = by2.get("$266", ())
+    p("  %d vs %d anchors" % (len(anchors1), len(anchors2)))
+
+    def categorize(anchors):
+        ext = []
+        ext_set = set()
+        internal = []
+        ua = _unwrap
+        ext_append = ext.append
+        ext_add = ext_set.add
+        int_append = internal.append
+        for frag in anchors:
+            val = ua(frag.value)
+            if not isinstance(val, _DICT_TYPES):
+                continue
+            # One get() with a sentinel instead of a membership check plus a
+            # second lookup; None is a legal value for the key.
+            url = val.get("$186", _MISSING)
+            if url is not _MISSING:
+                url = str(url)
+                ext_append(url)
+                ext_add(url)
+            else:
+                int_append(str(frag.fid))
+        return ext, ext_set, internal
+
+    ext1, ext1_set, int1 = categorize(anchors1)
+    ext2, ext2_set, int2 = categorize(anchors2)
+    p("  %d vs %d internal, %d vs %d external"
+      % (len(int1), len(int2), len(ext1), len(ext2)))
+    for url in sorted(ext1_set - ext2_set):
+        p("  %sURL only in file1: %s%s" % (RED, url, RESET))
+    for url in sorted(ext2_set - ext1_set):
+        p("  %sURL only in file2: %s%s" % (RED, url, RESET))
+    if ext1_set == ext2_set:
+        p("  %s✓%s external URLs match" % (GREEN, RESET))
+
+
+def analyze_metadata(by1, by2, out):
+    p = partial(print, file=out)
+    p()
+    p("=== Metadata ===")
+
+    def flatten(by_type):
+        meta = {}
+        for frag in by_type.get("$490", ()):
+            val = _unwrap(frag.value)
+            if not isinstance(val, _DICT_TYPES):
+                continue
+            for cat in _unwrap(val.get("$491", [])):
+                cat = _unwrap(cat)
+                if not isinstance(cat, _DICT_TYPES):
+                    continue
+                for entry in _unwrap(cat.get("$258", [])):
+                    entry = _unwrap(entry)
+                    if isinstance(entry, _DICT_TYPES):
+                        meta[str(entry.get("$492"))] = str(entry.get("$307"))
+        return meta
+
+    meta1 = flatten(by1)
+    meta2 = flatten(by2)
+    changed = [k for k in meta1 if k in meta2 and meta1[k] != meta2[k]]
+    if not changed and set(meta1) == set(meta2):
+        p("  %s✓%s all %d entries match" % (GREEN, RESET, len(meta1)))
+        return
+    for key in sorted(changed):
+        p("  %s%s: %r -> %r%s" % (YELLOW, key, meta1[key], meta2[key], RESET))
+    for key in sorted(set(meta1) - set(meta2)):
+        p("  %sonly in file1: %s = %r%s" % (RED, key, meta1[key], RESET))
+    for key in sorted(set(meta2) - set(meta1)):
+        p("  %sonly in file2: %s = %r%s" % (RED, key, meta2[key], RESET))
+
+
+def analyze_text_content(by1, by2, out):
+    p = partial(print, file=out)
+    p()
+    p("=== Text content ===")
+    # Totals accumulate during extraction rather than in a second full pass
+    # over the collected blocks.
+    texts1 = []
+    total1 = 0
+    for frag in by1.get("$145", ()):
+        blocks = extract_pure_text(frag.value)
+        texts1.extend(blocks)
+        total1 += sum(map(len, blocks))
+    texts2 = []
+    total2 = 0
+    for frag in by2.get("$145", ()):
+        blocks = extract_pure_text(frag.value)
+        texts2.extend(blocks)
+        total2 += sum(map(len, blocks))
+    p("  %d vs %d text blocks, %d vs %d chars"
+      % (len(texts1), len(texts2), total1, total2))
+
+    full1 = " ".join(texts1)
+    full2 = " ".join(texts2)
+    # Cheap outs before the fuzzy match: wildly different lengths can't score
+    # well, and equal hashes mean there's nothing to score.
+    n1, n2 = len(full1), len(full2)
+    if n1 and n2 and abs(n1 - n2) > 0.5 * max(n1, n2):
+        p("  %slengths differ by more than half; skipping similarity%s"
+          % (RED, RESET))
+        return
+    if hashlib.blake2b(full1.encode("utf-8")).digest() == \
+            hashlib.blake2b(full2.encode("utf-8")).digest():
+        p("  %s✓%s text identical" % (GREEN, RESET))
+        return
+    # Block-level Jaccard as a preliminary: when virtually every text block
+    # appears in both files the full-blob match can only confirm
+    # "near-identical", so skip it. xxh3 sidesteps per-string SipHash cost.
+    h = xxhash.xxh3_64_intdigest
+    set1 = {h(t) for t in texts1}
+    set2 = {h(t) for t in texts2}
+    union = len(set1 | set2)
+    jaccard = len(set1 & set2) / union if union else 1.0
+    if jaccard > 0.999:
+        p("  %s✓%s %.2f%% of text blocks shared; skipping full similarity"
+          % (GREEN, RESET, jaccard * 100.0))
+        return
+    score = similarity(full1, full2)
+    color = GREEN if score > 0.99 else (YELLOW if score > 0.9 else RED)
+    p("  %ssimilarity: %.2f%%%s" % (color, score * 100.0, RESET))
+    # Vectorized first-mismatch scan over the UTF-8 bytes instead of a
+    # char-by-char Python loop over millions of positions.
+    b1 = np.frombuffer(full1.encode("utf-8"), dtype=np.uint8)
+    b2 = np.frombuffer(full2.encode("utf-8"), dtype=np.uint8)
+    n = min(len(b1), len(b2))
+    neq = b1[:n] != b2[:n]
+    if neq.any():
+        i = int(np.argmax(neq))
+        # Snap back off any UTF-8 continuation byte (0b10xxxxxx) so the byte
+        # offset lands on a character boundary before converting.
+        while i > 0 and (b1[i] & 0xC0) == 0x80:
+            i -= 1
+        char_i = len(bytes(b1[:i]).decode("utf-8"))
+        p("  first difference at char %d:" % char_i)
+        p("    file1: %r" % full1[max(0, char_i - 30):char_i + 30])
+        p("    file2: %r" % full2[max(0, char_i - 30):char_i + 30])
+    elif len(full1) != len(full2):
+        p("  texts share a %d-char prefix; lengths differ"
+          % min(len(full1), len(full2)))
+
+
+def _files_identical(file1, file2):
+    """True when the two files are byte-for-byte the same on disk."""
+    if os.stat(file1).st_size != os.stat(file2).st_size:
+        return False
+    if os.path.samefile(file1, file2):
+        return True
+    with open(file1, "rb") as a, open(file2, "rb") as b:
+        with mmap.mmap(a.fileno(), 0, access=mmap.ACCESS_READ) as m1, \
+                mmap.mmap(b.fileno(), 0, access=mmap.ACCESS_READ) as m2:
+            return xxhash.xxh3_128(m1).digest() == xxhash.xxh3_128(m2).digest()
+
+
+def smart_diff(file1, file2):
+    # Identical bytes can't produce anything but a page of green check marks;
+    # hashing the mapped files is essentially free next to a full load.
+    if _files_identical(file1, file2):
+        print("Files are byte-identical; nothing to compare.")
+        return
+    print("Loading %s and %s..." % (file1, file2))
+    # The two loads are independent; overlap the disk reads and parses.
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        fut1 = ex.submit(load_kfx, file1)
+        fut2 = ex.submit(load_kfx, file2)
+        frags1, method1 = fut1.result()
+        frags2, method2 = fut2.result()
+    print("  %d vs %d fragments (%s / %s)"
+          % (len(frags1.all_fragments), len(frags2.all_fragments), method1, method2))
+
+    # One pass per file builds the type index the summary and every analyzer
+    # share, instead of re-scanning all_fragments per types()/count()/get_all().
+    by1 = {}
+    for f in frags1.all_fragments:
+        by1.setdefault(f.ftype, []).append(f)
+    by2 = {}
+    for f in frags2.all_fragments:
+        by2.setdefault(f.ftype, []).append(f)
+
+    print()
+    print("=== Fragment summary ===")
+    mark = _mark
+    for ftype in sorted(by1.keys() | by2.keys()):
+        c1 = len(by1.get(ftype, ()))
+        c2 = len(by2.get(ftype, ()))
+        print("  %-28s %5d vs %5d  %s" % (sym(ftype), c1, c2, mark(c2 - c1)))
+
+    # The analyzers only read frags1/frags2, so run them concurrently, each
+    # into its own buffer, and flush in the report's fixed order.
+    analyzers = (analyze_styles, analyze_sections, analyze_anchors,
+                 analyze_metadata, analyze_text_content)
+    bufs = [io.StringIO() for _ in analyzers]
+    with ThreadPoolExecutor(max_workers=len(analyzers)) as ex:
+        futures = [ex.submit(fn, by1, by2, buf)
+                   for fn, buf in zip(analyzers, bufs)]
+        for future in futures:
+            future.result()
+    for buf in bufs:
+        sys.stdout.write(buf.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quick regression report between two KFX builds")
+    parser.add_argument("file1", help="baseline KFX file")
+    parser.add_argument("file2", help="candidate KFX file")
+    args = parser.parse_args()
+    smart_diff(args.file1, args.file2)
+
+
+if __name__ == "__main__":
+    main()
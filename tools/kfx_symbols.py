@@ -0,0 +1,92 @@
+"""Human-readable names for the YJ symbols the KFX tools print.
+
+Generated from the `// N` comments in src/kfx/symbols.rs — only the ids
+the dump tools actually surface, not the full 852-entry table.
+"""
+import functools
+
+KNOWN_SYMBOLS = {
+    "$141": "page_templates",
+    "$142": "style_events",
+    "$143": "offset",
+    "$144": "length",
+    "$145": "content",
+    "$146": "content_list",
+    "$155": "id",
+    "$157": "style",
+    "$159": "type",
+    "$161": "format",
+    "$162": "mime",
+    "$164": "external_resource",
+    "$165": "location",
+    "$166": "search_path",
+    "$169": "reading_orders",
+    "$170": "sections",
+    "$173": "style_name",
+    "$174": "section_name",
+    "$175": "resource_name",
+    "$176": "story_name",
+    "$178": "reading_order_name",
+    "$179": "link_to",
+    "$180": "anchor_name",
+    "$181": "contains",
+    "$182": "locations",
+    "$183": "position",
+    "$184": "pid",
+    "$185": "eid",
+    "$186": "uri",
+    "$212": "toc",
+    "$213": "scrubbers",
+    "$214": "thumbnails",
+    "$241": "representation",
+    "$244": "label",
+    "$246": "target_position",
+    "$247": "entries",
+    "$249": "path",
+    "$250": "shape_list",
+    "$252": "container_list",
+    "$258": "metadata",
+    "$259": "storyline",
+    "$260": "section",
+    "$264": "position_map",
+    "$265": "position_id_map",
+    "$266": "anchor",
+    "$269": "text",
+    "$270": "container",
+    "$271": "image",
+    "$272": "kvg",
+    "$307": "value",
+    "$389": "book_navigation",
+    "$390": "section_navigation",
+    "$391": "nav_container",
+    "$392": "nav_containers",
+    "$393": "nav_unit",
+    "$394": "conditional_nav_group_unit",
+    "$395": "resource_path",
+    "$403": "index",
+    "$417": "bcRawMedia",
+    "$419": "container_entity_map",
+    "$490": "book_metadata",
+    "$491": "categorised_metadata",
+    "$492": "key",
+    "$495": "category",
+    "$538": "document_data",
+    "$550": "location_map",
+    "$584": "alt_text",
+    "$585": "content_features",
+    "$586": "namespace",
+    "$590": "features",
+    "$593": "format_capabilities",
+    "$597": "auxiliary_data",
+    "$598": "kfx_id",
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def format_symbol(s):
+    """Render a "$NNN" symbol with its name when we know it, e.g. "$145 (content)"."""
+    s = str(s)
+    name = KNOWN_SYMBOLS.get(s)
+    if name is not None:
+        return "%s (%s)" % (s, name)
+    return s